@@ -1,21 +1,33 @@
+import os
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 from pathlib import Path
 import torchaudio
 import yaml
-from typing import Optional, Tuple, Dict
+import json
+import tempfile
+import zipfile
+from typing import Iterator, List, Optional, Tuple, Dict
 import numpy as np
+from src.utils.audio import get_resampler
 
 class TagLishDataset(Dataset):
     def __init__(self, 
                  config_path: str,
                  split: str = 'train',
-                 transform: Optional[torch.nn.Module] = None):
+                 transform: Optional[torch.nn.Module] = None,
+                 segment_length: Optional[float] = None):
         """
         Args:
             config_path: Path to config.yaml
             split: One of 'train', 'val', or 'test'
             transform: Optional transform to be applied to the audio
+            segment_length: Optional window in seconds; when set, each item is a
+                window of this length read directly from disk, at a random offset
+                for 'train' and centred for 'val'/'test', and speaker_embedding
+                holds only the x-vector rows whose diarization segments overlap
+                the window. Processed audio must be PCM WAV for the partial
+                read to skip decoding.
         """
         with open(config_path, 'r') as f:
             self.config = yaml.safe_load(f)
@@ -23,20 +35,33 @@ class TagLishDataset(Dataset):
         self.split = split
         self.transform = transform
         self.sample_rate = self.config['data']['sample_rate']
+        self.segment_length = segment_length
+        
+        # Resamplers cached per (orig_sr, target_sr) so FIR kernels are built once
+        self._resamplers: Dict[Tuple[int, int], torchaudio.transforms.Resample] = {}
         
         # Set up data directories
         self.processed_dir = Path(self.config['data']['processed_audio_dir'])
         self.features_dir = Path(self.config['data']['features_dir'])
         
-        # Get file lists
-        self.audio_files = sorted(list(self.processed_dir.glob('*.wav')))
-        self.feature_files = sorted(list(self.features_dir.glob('*_xvector.pt')))
+        # Speaker embeddings live in one memory-mapped file, opened lazily per process
+        with open(self.features_dir / 'embeddings.json', 'r') as f:
+            self._manifest = json.load(f)
+        self._emb = None
+        
+        # Get file names in one scandir pass, keeping only audio that has embeddings
+        self.audio_files, self._audio_mtime = self._list_audio_files()
+        self._emb_rows = [self._manifest['files'][os.path.splitext(name)[0]]
+                          for name in self.audio_files]
+        
+        # Cache per-file metadata so lengths are known without decoding audio
+        self._load_metadata()
         
         # Split dataset
         total_size = len(self.audio_files)
-        indices = np.arange(total_size)
-        np.random.seed(self.config['device']['seed'])
-        np.random.shuffle(indices)
+        # Local generator, leaves the global NumPy RNG untouched
+        rng = np.random.default_rng(self.config['device']['seed'])
+        indices = rng.permutation(total_size)
         
         train_size = int(total_size * self.config['data']['train_split'])
         val_size = int(total_size * self.config['data']['val_split'])
@@ -48,6 +73,143 @@ class TagLishDataset(Dataset):
         else:  # test
             self.indices = indices[train_size + val_size:]
             
+    def _list_audio_files(self) -> Tuple[List[str], float]:
+        """Sorted names of the processed WAV files that have embeddings, plus their newest mtime."""
+        if not self.processed_dir.exists():
+            return [], 0.0
+        
+        names = []
+        newest_mtime = 0.0
+        with os.scandir(self.processed_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.wav') and os.path.splitext(entry.name)[0] in self._manifest['files']:
+                    names.append(entry.name)
+                    newest_mtime = max(newest_mtime, entry.stat().st_mtime)
+        
+        return sorted(names), newest_mtime
+    
+    def _audio_path(self, actual_idx: int) -> str:
+        """Full path of the audio file at a given (unsplit) index."""
+        return os.path.join(self.processed_dir, self.audio_files[actual_idx])
+    
+    def _load_metadata(self):
+        """Read num_frames and sample_rate for every audio file, cached on disk."""
+        cache_path = self.processed_dir / 'metadata.npz'
+        names = np.array(self.audio_files)
+        
+        # Key on the audio files themselves; the directory mtime also changes
+        # whenever a cache file is written next to them
+        audio_mtime = self._audio_mtime
+        
+        # An unreadable or stale cache is just a miss
+        try:
+            with np.load(cache_path) as cache:
+                if float(cache['mtime']) == audio_mtime and np.array_equal(cache['names'], names):
+                    self._lengths = cache['lengths']
+                    self._srs = cache['sample_rates']
+                    return
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            pass
+        
+        lengths = []
+        sample_rates = []
+        for actual_idx in range(len(self.audio_files)):
+            info = torchaudio.info(self._audio_path(actual_idx))
+            lengths.append(info.num_frames)
+            sample_rates.append(info.sample_rate)
+        
+        self._lengths = np.array(lengths, dtype=np.int64)
+        self._srs = np.array(sample_rates, dtype=np.int64)
+        
+        # Write to a temp file and rename so readers never see a partial cache;
+        # an unwritable directory just means no cache
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.processed_dir, suffix='.npz', delete=False) as f:
+                tmp_path = f.name
+                np.savez(f,
+                         mtime=audio_mtime,
+                         names=names,
+                         lengths=self._lengths,
+                         sample_rates=self._srs)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def _get_embeddings(self) -> np.ndarray:
+        """Get the (num_rows, dim) embeddings memmap, opening it on first use."""
+        if self._emb is None:
+            num_rows, dim = self._manifest['num_rows'], self._manifest['dim']
+            if num_rows == 0:
+                self._emb = np.zeros((0, dim), dtype=np.float32)
+            else:
+                self._emb = np.memmap(self.features_dir / 'embeddings.bin',
+                                      dtype=np.float32,
+                                      mode='r',
+                                      shape=(num_rows, dim))
+        return self._emb
+    
+    def __getstate__(self) -> dict:
+        # Workers reopen the memmap instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state['_emb'] = None
+        return state
+    
+    def get_length(self, idx: int) -> int:
+        """Get the length in samples (at the target sample rate) of a given index."""
+        actual_idx = self.indices[idx]
+        num_frames = int(self._lengths[actual_idx])
+        sample_rate = int(self._srs[actual_idx])
+        
+        if self.segment_length is not None:
+            num_frames = min(num_frames, int(self.segment_length * sample_rate))
+        
+        if sample_rate != self.sample_rate:
+            return int(np.ceil(num_frames * self.sample_rate / sample_rate))
+        return num_frames
+    
+    def _sample_window(self, actual_idx: int) -> Tuple[int, int]:
+        """Pick (frame_offset, num_frames) to read, -1 meaning the whole file."""
+        if self.segment_length is None:
+            return 0, -1
+        
+        total_frames = int(self._lengths[actual_idx])
+        window = int(self.segment_length * int(self._srs[actual_idx]))
+        if total_frames <= window:
+            return 0, -1
+        
+        # Random crop for training, a fixed centre crop keeps val/test deterministic
+        if self.split == 'train':
+            frame_offset = int(torch.randint(total_frames - window + 1, (1,)))
+        else:
+            frame_offset = (total_frames - window) // 2
+        return frame_offset, window
+    
+    def _window_rows(self, actual_idx: int, frame_offset: int, num_frames: int) -> Tuple[int, int]:
+        """(start, count) of the embedding rows whose segments overlap the read window."""
+        start, count = self._emb_rows[actual_idx]
+        if num_frames < 0:
+            return start, count
+        
+        # Segments were cut at the target rate with the preprocessor's sizes
+        segment_size = int(self.config['diarization']['segment_length'] * self.sample_rate)
+        step = segment_size - int(self.config['diarization']['overlap'] * self.sample_rate)
+        scale = self.sample_rate / int(self._srs[actual_idx])
+        total = int(round(int(self._lengths[actual_idx]) * scale))
+        win_start = frame_offset * scale
+        win_end = (frame_offset + num_frames) * scale
+        
+        seg_starts = np.arange(count, dtype=np.int64) * step
+        # A tail segment aligned to the end follows the regular windows
+        if total >= segment_size and count > (total - segment_size) // step + 1:
+            seg_starts[-1] = total - segment_size
+        
+        overlaps = np.flatnonzero((seg_starts < win_end) & (seg_starts + segment_size > win_start))
+        if len(overlaps) == 0:
+            return start, count
+        return start + int(overlaps[0]), int(overlaps[-1] - overlaps[0] + 1)
+    
     def __len__(self) -> int:
         return len(self.indices)
     
@@ -57,17 +219,21 @@ class TagLishDataset(Dataset):
         actual_idx = self.indices[idx]
         
         # Load audio
-        audio_path = self.audio_files[actual_idx]
-        waveform, sample_rate = torchaudio.load(str(audio_path))
+        audio_path = self._audio_path(actual_idx)
+        frame_offset, num_frames = self._sample_window(actual_idx)
+        waveform, sample_rate = torchaudio.load(audio_path,
+                                                frame_offset=frame_offset,
+                                                num_frames=num_frames,
+                                                backend='soundfile')
         
         # Ensure correct sample rate
         if sample_rate != self.sample_rate:
-            resampler = torchaudio.transforms.Resample(sample_rate, self.sample_rate)
-            waveform = resampler(waveform)
+            waveform = get_resampler(self._resamplers, sample_rate, self.sample_rate)(waveform)
         
         # Load speaker embeddings
-        feature_path = self.feature_files[actual_idx]
-        speaker_embedding = torch.load(feature_path)
+        start, count = self._window_rows(actual_idx, frame_offset, num_frames)
+        rows = self._get_embeddings()[start:start + count]
+        speaker_embedding = torch.from_numpy(rows.copy()).reshape(count, *self._manifest['row_shape'])
         
         # Apply transform if specified
         if self.transform is not None:
@@ -76,33 +242,123 @@ class TagLishDataset(Dataset):
         return {
             'waveform': waveform,
             'speaker_embedding': speaker_embedding,
-            'audio_path': str(audio_path)
+            'audio_path': audio_path
         }
     
     @staticmethod
     def collate_fn(batch: list) -> Dict[str, torch.Tensor]:
-        """Custom collate function for batching."""
+        """
+        Custom collate function for batching.
+        
+        DataLoader(pin_memory=True) pins every tensor in the returned dict, so
+        batches can be moved with .to(device, non_blocking=True); a typical
+        loader is
+        
+            DataLoader(dataset, collate_fn=TagLishDataset.collate_fn,
+                       pin_memory=True, num_workers=4,
+                       persistent_workers=True, prefetch_factor=4)
+        
+        Keep num_workers modest: each worker holds its own copy of the dataset
+        state, so resident memory grows with the worker count.
+        
+        Args:
+            batch: List of samples from __getitem__
+        """
         # Get max audio length in batch
-        max_length = max(x['waveform'].shape[1] for x in batch)
+        lengths = torch.tensor([x['waveform'].shape[1] for x in batch], dtype=torch.long)
+        max_length = int(lengths.max())
         
-        # Pad audio to max length
-        waveforms = []
-        speaker_embeddings = []
-        audio_paths = []
+        # Attention mask from the unpadded lengths, 1 for real samples
+        attention_mask = (torch.arange(max_length).unsqueeze(0) < lengths.unsqueeze(1)).long()
         
-        for sample in batch:
-            waveform = sample['waveform']
-            padding_length = max_length - waveform.shape[1]
-            
-            if padding_length > 0:
-                waveform = torch.nn.functional.pad(waveform, (0, padding_length))
-            
-            waveforms.append(waveform)
-            speaker_embeddings.append(sample['speaker_embedding'])
-            audio_paths.append(sample['audio_path'])
+        # Copy audio into one preallocated batch, zeroing only the padded tails
+        first = batch[0]['waveform']
+        waveforms = torch.empty(len(batch), first.shape[0], max_length, dtype=first.dtype)
+        
+        for i, sample in enumerate(batch):
+            length = sample['waveform'].shape[1]
+            waveforms[i, :, :length].copy_(sample['waveform'])
+            if length < max_length:
+                waveforms[i, :, length:].zero_()
         
         return {
-            'waveforms': torch.stack(waveforms),
-            'speaker_embeddings': torch.stack(speaker_embeddings),
-            'audio_paths': audio_paths
-        }
\ No newline at end of file
+            'waveforms': waveforms,
+            'attention_mask': attention_mask,
+            'lengths': lengths,
+            'speaker_embeddings': torch.stack([x['speaker_embedding'] for x in batch]),
+            'audio_paths': [x['audio_path'] for x in batch]
+        }
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler that groups samples of similar length to minimize padding.
+    
+    Each epoch the indices are permuted, sorted by length within chunks of
+    bucket_factor * batch_size samples, sliced into batches and the batches
+    shuffled, so batch composition changes between epochs.
+    
+    Use as DataLoader(dataset, batch_sampler=LengthBucketSampler(dataset, 4), ...).
+    """
+    def __init__(self,
+                 dataset: TagLishDataset,
+                 batch_size: int,
+                 shuffle: bool = True,
+                 drop_last: bool = False,
+                 seed: Optional[int] = None,
+                 bucket_factor: int = 50):
+        """
+        Args:
+            dataset: Dataset exposing get_length(idx)
+            batch_size: Number of samples per batch
+            shuffle: Whether to reshuffle samples and batches each epoch
+            drop_last: Whether to drop the last incomplete batch
+            seed: Seed for shuffling, defaults to config['device']['seed']
+            bucket_factor: Chunk size in batches within which samples are length-sorted
+        """
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = dataset.config['device']['seed'] if seed is None else seed
+        self.chunk_size = bucket_factor * batch_size
+        self.epoch = 0
+        self.lengths = np.array([dataset.get_length(i) for i in range(len(dataset))], dtype=np.int64)
+    
+    def set_epoch(self, epoch: int):
+        """Set the epoch explicitly, e.g. when resuming training."""
+        self.epoch = epoch
+    
+    def _make_batches(self, rng: Optional[np.random.Generator]) -> List[List[int]]:
+        """Sort by length within chunks and slice the chunks into batches."""
+        if rng is None:
+            # Without shuffling one global sort gives the least padding
+            order = np.argsort(self.lengths, kind='stable')
+            chunks = [order]
+        else:
+            perm = rng.permutation(len(self.lengths))
+            # chunk_size is a multiple of batch_size, so only the last batch can be short
+            chunks = [perm[i:i + self.chunk_size] for i in range(0, len(perm), self.chunk_size)]
+            chunks = [chunk[np.argsort(self.lengths[chunk], kind='stable')] for chunk in chunks]
+        
+        batches = [chunk[i:i + self.batch_size].tolist()
+                   for chunk in chunks
+                   for i in range(0, len(chunk), self.batch_size)]
+        if self.drop_last:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        return batches
+    
+    def __iter__(self) -> Iterator[List[int]]:
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            batches = self._make_batches(rng)
+            # Advance so the next pass reshuffles even without set_epoch
+            self.epoch += 1
+            for i in rng.permutation(len(batches)):
+                yield batches[i]
+        else:
+            yield from self._make_batches(None)
+    
+    def __len__(self) -> int:
+        n = len(self.lengths)
+        if self.drop_last:
+            return n // self.batch_size
+        return -(-n // self.batch_size)
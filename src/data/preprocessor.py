@@ -1,12 +1,49 @@
 import torch
+import torch.nn as nn
 import torchaudio
 import numpy as np
 from pathlib import Path
 import yaml
 import logging
-from typing import Tuple, Optional
-from speechbrain.pretrained import EncoderClassifier
-from torch.nn.utils.rnn import pad_sequence
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple, Optional
+from src.utils.audio import get_resampler, segment_waveform
+from src.utils.model_cache import get_x_vector_model
+
+class AudioFrontEnd(nn.Module):
+    """Mono mix, normalization and silence trimming as a single module."""
+    def __init__(self, normalize: bool, trim_silence: bool, silence_threshold: float):
+        """
+        Args:
+            normalize: Whether to normalize to zero mean and unit variance
+            trim_silence: Whether to trim leading/trailing silence
+            silence_threshold: Amplitude below which samples count as silence
+        """
+        super().__init__()
+        self.normalize = normalize
+        self.trim_silence = trim_silence
+        self.silence_threshold = silence_threshold
+    
+    def forward(self, waveform: torch.Tensor) -> torch.Tensor:
+        # Convert to mono if stereo
+        if waveform.shape[0] > 1:
+            waveform = waveform.mean(dim=0, keepdim=True)
+        
+        # Normalize audio
+        if self.normalize:
+            waveform = (waveform - waveform.mean()) / waveform.std().clamp_min(1e-8)
+        
+        # Trim silence using energy-based VAD
+        if self.trim_silence:
+            speech_idx = (waveform.abs().squeeze(0) > self.silence_threshold).nonzero(as_tuple=True)[0]
+            
+            # Nothing above threshold, keep the audio as is
+            if speech_idx.numel() > 0:
+                waveform = waveform[:, speech_idx[0]:speech_idx[-1] + 1]
+        
+        return waveform
 
 class AudioPreprocessor:
     def __init__(self, config_path: str):
@@ -17,88 +54,157 @@ class AudioPreprocessor:
         self.device = torch.device('cuda' if torch.cuda.is_available() and 
                                  self.config['device']['use_cuda'] else 'cpu')
         
-        # Initialize x-vector model for speaker diarization
-        self.x_vector_model = EncoderClassifier.from_hparams(
+        # Embeddings only feed clustering, so a lower precision model is close enough
+        self.embedding_precision = 'float32'
+        if self.config['diarization']['quantize_embedding_model']:
+            self.embedding_precision = 'int8' if self.device.type == 'cpu' else 'float16'
+        
+        # Initialize x-vector model for speaker diarization (shared per process)
+        self.x_vector_model = get_x_vector_model(
             source=self.config['diarization']['embedding_model'],
-            savedir="models/pretrained/x_vector"
+            savedir="models/pretrained/x_vector",
+            precision=self.embedding_precision,
+            device=str(self.device)
         )
-        self.x_vector_model.to(self.device)
+        
+        # Resamplers cached per (orig_sr, target_sr) and kept on self.device
+        self._resamplers: Dict[Tuple[int, int], torchaudio.transforms.Resample] = {}
+        
+        # Audio front end, compiled once on CUDA so every file reuses the fused kernels;
+        # no CUDA graphs, since every file has a different length
+        self.front_end = AudioFrontEnd(
+            normalize=self.config['audio']['normalize_audio'],
+            trim_silence=self.config['audio']['trim_silence'],
+            silence_threshold=self.config['audio']['silence_threshold']
+        ).to(self.device)
+        if self.device.type == 'cuda':
+            self.front_end = torch.compile(self.front_end, mode='max-autotune-no-cudagraphs', dynamic=True)
+        
+        # Side stream for host-to-device copies so they overlap with compute
+        self._copy_stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        
+        # Upper bound on segments per x-vector forward pass
+        self.embedding_batch_size = self.config['diarization']['embedding_batch_size']
 
-    def load_audio(self, audio_path: str) -> Tuple[torch.Tensor, int]:
-        """Load and resample audio file."""
-        waveform, sample_rate = torchaudio.load(audio_path)
+    def _read_audio(self,
+                    audio_path: str,
+                    frame_offset: int = 0,
+                    num_frames: int = -1) -> Tuple[torch.Tensor, int]:
+        """Decode audio on the host, pinned when it will be copied to the GPU."""
+        waveform, sample_rate = torchaudio.load(audio_path,
+                                                frame_offset=frame_offset,
+                                                num_frames=num_frames,
+                                                backend='soundfile')
         
-        if sample_rate != self.sample_rate:
-            resampler = torchaudio.transforms.Resample(sample_rate, self.sample_rate)
-            waveform = resampler(waveform)
+        if self._copy_stream is not None:
+            waveform = waveform.pin_memory()
         
-        return waveform, self.sample_rate
+        return waveform, sample_rate
 
-    def process_audio(self, waveform: torch.Tensor) -> torch.Tensor:
-        """Apply audio preprocessing steps."""
-        # Convert to mono if stereo
-        if waveform.shape[0] > 1:
-            waveform = torch.mean(waveform, dim=0, keepdim=True)
+    def _to_device(self, waveform: torch.Tensor) -> torch.Tensor:
+        """Copy a waveform to self.device on the copy stream."""
+        if self._copy_stream is None:
+            return waveform.to(self.device)
         
-        # Normalize audio if configured
-        if self.config['audio']['normalize_audio']:
-            waveform = (waveform - waveform.mean()) / waveform.std()
+        with torch.cuda.stream(self._copy_stream):
+            waveform = waveform.to(self.device, non_blocking=True)
         
-        # Trim silence if configured
-        if self.config['audio']['trim_silence']:
-            waveform = self._trim_silence(waveform)
+        # Compute on the default stream waits for the copy to land
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self._copy_stream)
+        waveform.record_stream(current_stream)
         
         return waveform
 
-    def _trim_silence(self, waveform: torch.Tensor) -> torch.Tensor:
-        """Remove silence from the audio using energy-based VAD."""
-        threshold = self.config['audio']['silence_threshold']
-        energy = torch.abs(waveform)
-        masks = energy > threshold
+    def _resample(self, waveform: torch.Tensor, sample_rate: int) -> torch.Tensor:
+        """Resample a device-resident waveform to the target sample rate."""
+        if sample_rate != self.sample_rate:
+            waveform = get_resampler(self._resamplers, sample_rate, self.sample_rate, self.device)(waveform)
         
-        # Find start and end of speech
-        start = masks.argmax()
-        end = len(masks) - masks.flip(1).argmax()
+        return waveform
+
+    def load_audio(self,
+                   audio_path: str,
+                   frame_offset: int = 0,
+                   num_frames: int = -1) -> Tuple[torch.Tensor, int]:
+        """
+        Load and resample audio file, the waveform is returned on self.device.
+        
+        Args:
+            audio_path: Path to the audio file
+            frame_offset: First frame to read
+            num_frames: Number of frames to read, -1 for the rest of the file
+        """
+        waveform, sample_rate = self._read_audio(audio_path, frame_offset, num_frames)
+        waveform = self._resample(self._to_device(waveform), sample_rate)
         
-        return waveform[:, start:end]
+        return waveform, self.sample_rate
 
-    def extract_speaker_embeddings(self, waveform: torch.Tensor) -> torch.Tensor:
-        """Extract x-vector embeddings for speaker diarization."""
+    def process_audio(self, waveform: torch.Tensor) -> torch.Tensor:
+        """Apply audio preprocessing steps on self.device."""
+        waveform = waveform.to(self.device, non_blocking=True)
+        
+        return self.front_end(waveform).contiguous()
+
+    def _split_segments(self, waveform: torch.Tensor) -> torch.Tensor:
+        """Split audio into the configured overlapping diarization segments."""
         segment_length = int(self.config['diarization']['segment_length'] * self.sample_rate)
         overlap = int(self.config['diarization']['overlap'] * self.sample_rate)
         
-        # Split audio into overlapping segments
-        segments = []
-        for start in range(0, waveform.shape[1] - segment_length + 1, segment_length - overlap):
-            end = start + segment_length
-            segment = waveform[:, start:end]
-            segments.append(segment)
+        return segment_waveform(waveform, segment_length, segment_length - overlap)
+
+    def _encode_segments(self, segments: torch.Tensor) -> torch.Tensor:
+        """Run the x-vector model on a batch of segments, the embedding network in FP16 if selected."""
+        mods = self.x_vector_model.mods
+        segments = segments.to(self.device).float()
+        wav_lens = torch.ones(segments.shape[0], device=self.device)
         
-        # Pad last segment if necessary
-        if waveform.shape[1] % segment_length != 0:
-            last_segment = waveform[:, -(segment_length):]
-            segments.append(last_segment)
+        # Same steps as encode_batch, split so only the embedding network is autocast
+        with torch.inference_mode():
+            # Filterbank features stay in float32, the power spectrum can overflow fp16
+            feats = mods.compute_features(segments)
+            feats = mods.mean_var_norm(feats, wav_lens)
+            
+            with torch.autocast(device_type=self.device.type,
+                                dtype=torch.float16,
+                                enabled=self.embedding_precision == 'float16'):
+                embeddings = mods.embedding_model(feats, wav_lens)
         
-        # Convert segments to batch
-        segments_batch = pad_sequence(segments, batch_first=True)
+        return embeddings.float()
+
+    def _encode_in_slices(self, segments: torch.Tensor) -> torch.Tensor:
+        """Encode segments in slices of at most embedding_batch_size."""
+        return torch.cat([self._encode_segments(segments[start:start + self.embedding_batch_size])
+                          for start in range(0, segments.shape[0], self.embedding_batch_size)], dim=0)
+
+    def extract_speaker_embeddings(self, waveform: torch.Tensor) -> torch.Tensor:
+        """Extract x-vector embeddings for speaker diarization."""
+        segments_batch = self._split_segments(waveform)
         
         # Extract x-vector embeddings
-        with torch.no_grad():
-            embeddings = self.x_vector_model.encode_batch(segments_batch)
-        
-        return embeddings
+        return self._encode_in_slices(segments_batch)
 
-    def save_processed_audio(self, 
-                           waveform: torch.Tensor, 
-                           embeddings: torch.Tensor,
-                           output_path: Path,
-                           features_path: Path):
-        """Save processed audio and features."""
+    def _save_processed(self,
+                        waveform: torch.Tensor,
+                        embeddings: torch.Tensor,
+                        output_path: Path,
+                        stem: str):
+        """
+        Save processed audio and append its features to the embeddings file.
+        
+        Only valid inside process_dataset, which opens the embeddings file and manifest.
+        """
         # Save processed waveform
-        torchaudio.save(output_path, waveform, self.sample_rate)
+        torchaudio.save(output_path, waveform.cpu(), self.sample_rate)
+        
+        # Append speaker embeddings as float32 rows of shape (num_segments, dim)
+        rows = embeddings.detach().float().cpu().reshape(-1, embeddings.shape[-1]).numpy()
+        self._embeddings_file.write(rows.tobytes())
         
-        # Save speaker embeddings
-        torch.save(embeddings, features_path)
+        self._manifest['dim'] = rows.shape[1]
+        self._manifest['row_shape'] = list(embeddings.shape[1:])
+        self._manifest['files'][stem] = [self._manifest['num_rows'], rows.shape[0]]
+        self._manifest['num_rows'] += rows.shape[0]
 
     def process_dataset(self, input_dir: str, output_dir: str, features_dir: str):
         """Process entire dataset."""
@@ -110,25 +216,99 @@ class AudioPreprocessor:
         output_path.mkdir(parents=True, exist_ok=True)
         features_path.mkdir(parents=True, exist_ok=True)
         
-        for audio_file in input_path.glob('*.wav'):
-            try:
-                # Load and process audio
-                waveform, _ = self.load_audio(str(audio_file))
-                processed_waveform = self.process_audio(waveform)
+        # All embeddings go to one flat float32 file, indexed by a JSON manifest
+        self._embeddings_file = open(features_path / 'embeddings.bin', 'wb')
+        self._manifest = {'num_rows': 0, 'dim': 0, 'row_shape': [], 'files': {}}
+        
+        try:
+            self._process_files(input_path, output_path)
+        finally:
+            self._embeddings_file.close()
+            with open(features_path / 'embeddings.json', 'w') as f:
+                json.dump(self._manifest, f)
+
+    def _process_files(self, input_path: Path, output_path: Path):
+        """Process every WAV file in input_path, batching x-vector extraction."""
+        # Files whose segments are waiting to go through the x-vector model
+        self._pending = []
+        audio_files = iter(sorted(input_path.glob('*.wav')))
+        
+        # Decode upcoming files in the background while the current one is on the GPU,
+        # with at most prefetch files held in host memory
+        prefetch = 4
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            in_flight = deque()
+            for audio_file in audio_files:
+                in_flight.append((audio_file, executor.submit(self._read_audio, str(audio_file))))
+                if len(in_flight) == prefetch:
+                    break
+            
+            while in_flight:
+                audio_file, future = in_flight.popleft()
+                next_file = next(audio_files, None)
+                if next_file is not None:
+                    in_flight.append((next_file, executor.submit(self._read_audio, str(next_file))))
                 
-                # Extract speaker embeddings
-                embeddings = self.extract_speaker_embeddings(processed_waveform)
+                try:
+                    # Load and process audio
+                    waveform, sample_rate = future.result()
+                    waveform = self._resample(self._to_device(waveform), sample_rate)
+                    processed_waveform = self.process_audio(waveform)
+                    
+                    # Queue segments for batched speaker embedding extraction
+                    output_file = output_path / audio_file.name
+                    self._pending.append((audio_file.name,
+                                          processed_waveform,
+                                          self._split_segments(processed_waveform),
+                                          output_file,
+                                          audio_file.stem))
+                    
+                except Exception as e:
+                    logging.error(f"Error processing {audio_file.name}: {str(e)}")
+                    continue
                 
+                if sum(item[2].shape[0] for item in self._pending) >= self.embedding_batch_size:
+                    self._flush_pending()
+        
+        self._flush_pending()
+
+    def _flush_pending(self):
+        """Extract embeddings for all pending files together and save them."""
+        if not self._pending:
+            return
+        
+        pending, self._pending = self._pending, []
+        names = [item[0] for item in pending]
+        
+        try:
+            # Encode segments from every pending file together, capped per forward pass
+            segments = torch.cat([item[2] for item in pending], dim=0)
+            embeddings = self._encode_in_slices(segments)
+            per_file = list(torch.split(embeddings, [item[2].shape[0] for item in pending]))
+        except Exception as e:
+            # Retry file by file so a failure only loses the file that caused it
+            logging.warning(f"Batched embedding extraction failed for {', '.join(names)}, "
+                            f"retrying per file: {str(e)}")
+            per_file = []
+            for name, _, file_segments, _, _ in pending:
+                try:
+                    per_file.append(self._encode_in_slices(file_segments))
+                except Exception as file_error:
+                    logging.error(f"Error extracting embeddings for {name}: {str(file_error)}")
+                    per_file.append(None)
+        
+        for (name, waveform, _, output_file, stem), file_embeddings in zip(pending, per_file):
+            if file_embeddings is None:
+                continue
+            
+            try:
                 # Save processed data
-                output_file = output_path / audio_file.name
-                features_file = features_path / f"{audio_file.stem}_xvector.pt"
-                
-                self.save_processed_audio(processed_waveform, 
-                                       embeddings,
-                                       output_file, 
-                                       features_file)
+                self._save_processed(waveform,
+                                     file_embeddings,
+                                     output_file,
+                                     stem)
                 
-                logging.info(f"Successfully processed {audio_file.name}")
+                logging.info(f"Successfully processed {name}")
                 
             except Exception as e:
-                logging.error(f"Error processing {audio_file.name}: {str(e)}")
\ No newline at end of file
+                logging.error(f"Error processing {name}: {str(e)}")
@@ -1,10 +1,20 @@
 import torch
 import torch.nn as nn
 from transformers import Wav2Vec2ForCTC, Wav2Vec2Processor
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 import yaml
 from pathlib import Path
 
+def _ctc_greedy_collapse(pred_ids: torch.Tensor, blank_id: int) -> List[List[int]]:
+    """Collapse repeats and drop blanks from greedy CTC predictions of shape (B, T)."""
+    # Keep a frame if it is not blank and differs from the previous frame
+    keep = pred_ids != blank_id
+    keep[:, 1:] &= pred_ids[:, 1:] != pred_ids[:, :-1]
+    
+    # One device-to-host copy for the whole batch
+    pred_ids, keep = pred_ids.cpu(), keep.cpu()
+    return [ids[mask].tolist() for ids, mask in zip(pred_ids, keep)]
+
 class TagLishWav2Vec2(nn.Module):
     def __init__(self, config_path: str):
         """
@@ -21,12 +31,25 @@ class TagLishWav2Vec2(nn.Module):
         
         # Initialize Wav2Vec2 model and processor
         self.model = Wav2Vec2ForCTC.from_pretrained(
-            self.config['wav2vec2']['model_name']
+            self.config['wav2vec2']['model_name'],
+            **self._model_kwargs()
         )
         self.processor = Wav2Vec2Processor.from_pretrained(
             self.config['wav2vec2']['model_name']
         )
         
+        self._configure_model()
+        
+    def _model_kwargs(self) -> Dict:
+        """Keyword arguments for Wav2Vec2ForCTC.from_pretrained."""
+        # SDPA dispatches to fused (FlashAttention) kernels where available
+        return {
+            'attn_implementation': 'sdpa',
+            'torch_dtype': torch.bfloat16 if self.config['wav2vec2'].get('bf16', False) else torch.float32
+        }
+    
+    def _configure_model(self):
+        """Apply freezing, dropout, checkpointing and compilation settings to self.model."""
         # Freeze feature encoder if specified
         if self.config['wav2vec2']['freeze_feature_encoder']:
             self._freeze_feature_encoder()
@@ -34,10 +57,26 @@ class TagLishWav2Vec2(nn.Module):
         # Set dropout values
         self._set_dropout_values()
         
+        # Trade recomputation for activation memory in the transformer encoder
+        if self.config['wav2vec2'].get('grad_checkpointing', False):
+            self.model.gradient_checkpointing_enable()
+        
+        # Compile in place so parameter names and save_pretrained are unchanged
+        if self.config['wav2vec2'].get('compile_model', False):
+            self.model.compile(mode='reduce-overhead')
+        
     def _freeze_feature_encoder(self):
         """Freeze the feature encoder layers of Wav2Vec2."""
-        for param in self.model.wav2vec2.feature_extractor.parameters():
-            param.requires_grad = False
+        # Disables gradients and autograd bookkeeping through the frozen stem
+        self.model.freeze_feature_encoder()
+        self.model.wav2vec2.feature_extractor.eval()
+    
+    def train(self, mode: bool = True) -> 'TagLishWav2Vec2':
+        """Set training mode, keeping a frozen feature encoder in eval mode."""
+        super().train(mode)
+        if self.config['wav2vec2']['freeze_feature_encoder']:
+            self.model.wav2vec2.feature_extractor.eval()
+        return self
     
     def _set_dropout_values(self):
         """Set dropout values according to configuration."""
@@ -55,15 +94,21 @@ class TagLishWav2Vec2(nn.Module):
         
         Args:
             batch: Dictionary containing:
-                - waveforms: Tensor of shape (batch_size, sequence_length)
+                - waveforms: Tensor of shape (batch_size, sequence_length) or
+                  (batch_size, 1, sequence_length)
                 - attention_mask: Optional mask for padding
             return_logits: Whether to return logits instead of loss
             
         Returns:
             Dictionary containing model outputs
         """
-        # Get inputs
+        # Get inputs, dropping the channel dim of (batch_size, 1, sequence_length) batches
         input_values = batch['waveforms']
+        if input_values.dim() == 3:
+            input_values = input_values.squeeze(1)
+        
+        # Match the weight dtype, e.g. bfloat16 when wav2vec2.bf16 is set
+        input_values = input_values.to(self.model.dtype)
         attention_mask = batch.get('attention_mask', None)
         
         # Process through Wav2Vec2
@@ -88,12 +133,33 @@ class TagLishWav2Vec2(nn.Module):
             
         return result
     
+    def eval_forward(self, batch: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """
+        Inference-only forward pass, without autograd and in bfloat16 on CUDA.
+        
+        Call .eval() first; use forward() for training.
+        
+        Args:
+            batch: Same as forward()
+            
+        Returns:
+            Dictionary containing logits and hidden states
+        """
+        device_type = batch['waveforms'].device.type
+        with torch.inference_mode(), torch.autocast(device_type=device_type,
+                                                    dtype=torch.bfloat16,
+                                                    enabled=device_type == 'cuda'):
+            return self.forward(batch, return_logits=True)
+    
     def prepare_input(self, 
                      waveforms: torch.Tensor,
                      sample_rate: int = 16000) -> Dict[str, torch.Tensor]:
         """
         Prepare input for the model.
         
+        Batches from TagLishDataset.collate_fn are already normalized and carry
+        an attention mask, so this is only needed for raw, unbatched audio.
+        
         Args:
             waveforms: Input audio waveforms
             sample_rate: Sample rate of the audio
@@ -124,13 +190,16 @@ class TagLishWav2Vec2(nn.Module):
         Returns:
             List of decoded predictions
         """
-        # Get predictions
-        pred_ids = torch.argmax(logits, dim=-1)
-        
-        # Decode predictions to text
-        predictions = self.processor.batch_decode(
-            pred_ids,
-            skip_special_tokens=skip_special_tokens
+        # Get predictions, collapsed to CTC output ids on device
+        pred_ids = logits.argmax(dim=-1)
+        tokenizer = self.processor.tokenizer
+        collapsed_ids = _ctc_greedy_collapse(pred_ids, tokenizer.pad_token_id)
+        
+        # Decode predictions to text, repeats and blanks are already removed
+        predictions = tokenizer.batch_decode(
+            collapsed_ids,
+            skip_special_tokens=skip_special_tokens,
+            group_tokens=False
         )
         
         return predictions
@@ -166,6 +235,7 @@ class TagLishWav2Vec2(nn.Module):
             Loaded TagLishWav2Vec2 model
         """
         instance = cls(config_path)
-        instance.model = Wav2Vec2ForCTC.from_pretrained(model_path)
+        instance.model = Wav2Vec2ForCTC.from_pretrained(model_path, **instance._model_kwargs())
         instance.processor = Wav2Vec2Processor.from_pretrained(model_path)
+        instance._configure_model()
         return instance
\ No newline at end of file
@@ -4,8 +4,8 @@ from typing import Dict, List, Tuple, Optional
 import numpy as np
 from pathlib import Path
 import yaml
-from sklearn.cluster import KMeans
-from speechbrain.pretrained import EncoderClassifier
+from src.utils.audio import segment_waveform
+from src.utils.model_cache import get_x_vector_model
 import torch.nn.functional as F
 
 class XVectorDiarizer(nn.Module):
@@ -22,17 +22,27 @@ class XVectorDiarizer(nn.Module):
         with open(config_path, 'r') as f:
             self.config = yaml.safe_load(f)
         
-        # Initialize x-vector model
-        self.x_vector_model = EncoderClassifier.from_hparams(
-            source=self.config['diarization']['embedding_model'],
-            savedir="models/pretrained/x_vector"
-        )
+        # The x-vector model is shared per process, so it is looked up on access
+        # rather than registered as a submodule that .to()/.train() would change
+        self._x_vector_source = self.config['diarization']['embedding_model']
+        self._x_vector_device = ('cuda' if torch.cuda.is_available() and
+                                 self.config['device']['use_cuda'] else 'cpu')
         
         # Set clustering parameters
         self.min_speakers = self.config['diarization']['min_speakers']
         self.max_speakers = self.config['diarization']['max_speakers']
         self.segment_length = self.config['diarization']['segment_length']
         self.overlap = self.config['diarization']['overlap']
+        self.selection_patience = self.config['diarization']['speaker_selection_patience']
+    
+    @property
+    def x_vector_model(self):
+        """Shared, read-only x-vector model."""
+        return get_x_vector_model(
+            source=self._x_vector_source,
+            savedir="models/pretrained/x_vector",
+            device=self._x_vector_device
+        )
     
     def extract_embeddings(self, 
                           waveform: torch.Tensor,
@@ -51,15 +61,7 @@ class XVectorDiarizer(nn.Module):
         segment_size = int(self.segment_length * sample_rate)
         step_size = int((self.segment_length - self.overlap) * sample_rate)
         
-        # Extract segments
-        segments = []
-        for start in range(0, waveform.shape[1] - segment_size + 1, step_size):
-            end = start + segment_size
-            segment = waveform[:, start:end]
-            segments.append(segment)
-        
-        # Convert segments to batch
-        segments = torch.stack(segments)
+        segments = segment_waveform(waveform, segment_size, step_size)
         
         # Extract embeddings
         with torch.no_grad():
@@ -67,42 +69,147 @@ class XVectorDiarizer(nn.Module):
         
         return embeddings
     
+    def _kmeans(self,
+                embeddings: torch.Tensor,
+                n_clusters: int,
+                max_iter: int = 100,
+                tol: float = 1e-4,
+                seed: int = 42) -> torch.Tensor:
+        """
+        K-means (Lloyd's algorithm with k-means++ init) on the embeddings' device.
+        
+        Args:
+            embeddings: Tensor of shape (num_segments, embedding_dim)
+            n_clusters: Number of clusters
+            max_iter: Maximum number of Lloyd iterations
+            tol: Stop once the squared centroid shift falls below this
+            seed: Seed for centroid initialization
+            
+        Returns:
+            Cluster labels of shape (num_segments,)
+        """
+        device = embeddings.device
+        generator = torch.Generator(device=device).manual_seed(seed)
+        num_samples = embeddings.shape[0]
+        
+        # k-means++ initialization, sampling proportional to squared distance
+        first = torch.randint(num_samples, (1,), generator=generator, device=device)
+        centroids = embeddings[first]
+        min_dists = torch.cdist(embeddings, centroids).squeeze(1).pow(2)
+        for _ in range(1, n_clusters):
+            weights = min_dists if min_dists.sum() > 0 else torch.ones_like(min_dists)
+            idx = torch.multinomial(weights, 1, generator=generator)
+            centroids = torch.cat([centroids, embeddings[idx]], dim=0)
+            new_dists = torch.cdist(embeddings, embeddings[idx]).squeeze(1).pow(2)
+            min_dists = torch.minimum(min_dists, new_dists)
+        
+        # Lloyd iterations, empty clusters keep their previous centroid
+        for _ in range(max_iter):
+            labels = torch.cdist(embeddings, centroids).argmin(dim=1)
+            sums = torch.zeros_like(centroids).index_add_(0, labels, embeddings)
+            counts = torch.bincount(labels, minlength=n_clusters).unsqueeze(1)
+            new_centroids = torch.where(counts > 0, sums / counts.clamp_min(1), centroids)
+            shift = (new_centroids - centroids).pow(2).sum()
+            centroids = new_centroids
+            if shift <= tol:
+                break
+        
+        return torch.cdist(embeddings, centroids).argmin(dim=1)
+    
+    def _silhouette_score(self,
+                          distances: torch.Tensor,
+                          labels: torch.Tensor,
+                          n_clusters: int) -> float:
+        """
+        Mean silhouette coefficient computed from a precomputed distance matrix.
+        
+        Args:
+            distances: Pairwise distances of shape (num_segments, num_segments)
+            labels: Cluster labels of shape (num_segments,)
+            n_clusters: Number of clusters
+            
+        Returns:
+            Mean silhouette score, 0 when fewer than two clusters are non-empty
+        """
+        if n_clusters < 2:
+            return 0.0
+        
+        # Sum of distances from every point to every cluster
+        one_hot = F.one_hot(labels, n_clusters).to(distances.dtype)
+        cluster_sums = distances @ one_hot
+        counts = one_hot.sum(dim=0)
+        # k-means can leave clusters empty, the score is undefined with one occupied cluster
+        if (counts > 0).sum() < 2:
+            return 0.0
+        
+        # Mean distance to own cluster (excluding self) and nearest other cluster
+        own_counts = counts[labels]
+        a = cluster_sums.gather(1, labels.unsqueeze(1)).squeeze(1) / (own_counts - 1).clamp_min(1)
+        mean_dists = cluster_sums / counts.clamp_min(1)
+        mean_dists = mean_dists.masked_fill(one_hot.bool() | (counts == 0), float('inf'))
+        b = mean_dists.min(dim=1).values
+        
+        # Points in singleton clusters score 0, b is only used where finite
+        valid = (own_counts > 1) & torch.isfinite(b)
+        b = torch.where(valid, b, a)
+        silhouette = (b - a) / torch.maximum(a, b).clamp_min(1e-12)
+        silhouette = torch.where(valid, silhouette, torch.zeros_like(silhouette))
+        
+        return silhouette.mean().item()
+    
     def cluster_speakers(self, 
                         embeddings: torch.Tensor,
-                        num_speakers: Optional[int] = None) -> Tuple[np.ndarray, float]:
+                        num_speakers: Optional[int] = None) -> Tuple[torch.Tensor, float]:
         """
         Cluster embeddings to identify speakers.
         
+        When the number of speakers is unknown, candidates from min_speakers up
+        are scored by silhouette and the sweep stops once the score has failed
+        to improve for speaker_selection_patience candidates.
+        
         Args:
             embeddings: X-vector embeddings
             num_speakers: Optional number of speakers (if known)
             
         Returns:
-            Tuple of speaker labels and clustering score
+            Tuple of speaker labels and silhouette score
         """
-        # Convert embeddings to numpy
-        embeddings_np = embeddings.cpu().numpy()
+        # Flatten to (num_segments, embedding_dim), staying on device
+        embeddings_flat = embeddings.reshape(-1, embeddings.shape[-1]).float()
+        num_segments = embeddings_flat.shape[0]
+        if num_segments == 0:
+            raise ValueError("Cannot cluster speakers without any embeddings")
+        if num_speakers is not None and num_speakers > num_segments:
+            raise ValueError(f"Cannot find {num_speakers} speakers in {num_segments} segments")
+        
+        distances = torch.cdist(embeddings_flat, embeddings_flat)
         
         if num_speakers is None:
-            # Try different numbers of speakers
+            # Try different numbers of speakers, never more than there are segments
             best_score = -float('inf')
             best_labels = None
+            min_speakers = min(self.min_speakers, num_segments)
+            max_speakers = min(self.max_speakers, num_segments)
+            stale = 0
             
-            for n_speakers in range(self.min_speakers, self.max_speakers + 1):
-                kmeans = KMeans(n_clusters=n_speakers, random_state=42)
-                labels = kmeans.fit_predict(embeddings_np)
-                score = kmeans.score(embeddings_np)
+            for n_speakers in range(min_speakers, max_speakers + 1):
+                labels = self._kmeans(embeddings_flat, n_speakers)
+                score = self._silhouette_score(distances, labels, n_speakers)
                 
                 if score > best_score:
                     best_score = score
                     best_labels = labels
+                    stale = 0
+                else:
+                    stale += 1
+                    if stale >= self.selection_patience:
+                        break
             
             return best_labels, best_score
         else:
             # Use specified number of speakers
-            kmeans = KMeans(n_clusters=num_speakers, random_state=42)
-            labels = kmeans.fit_predict(embeddings_np)
-            score = kmeans.score(embeddings_np)
+            labels = self._kmeans(embeddings_flat, num_speakers)
+            score = self._silhouette_score(distances, labels, num_speakers)
             
             return labels, score
     
@@ -130,12 +237,9 @@ class XVectorDiarizer(nn.Module):
         # Perform clustering
         labels, score = self.cluster_speakers(embeddings, num_speakers)
         
-        # Convert labels to tensor
-        labels_tensor = torch.from_numpy(labels).to(embeddings.device)
-        
         return {
             'embeddings': embeddings,
-            'speaker_labels': labels_tensor,
+            'speaker_labels': labels,
             'diarization_score': torch.tensor(score)
         }
     
@@ -167,8 +271,5 @@ class XVectorDiarizer(nn.Module):
             Loaded XVectorDiarizer model
         """
         instance = cls(config_path)
-        instance.x_vector_model = EncoderClassifier.from_hparams(
-            source=model_path,
-            savedir="models/pretrained/x_vector"
-        )
+        instance._x_vector_source = model_path
         return instance
\ No newline at end of file
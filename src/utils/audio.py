@@ -0,0 +1,67 @@
+import torch
+import torch.nn.functional as F
+import torchaudio
+from typing import Dict, Optional, Tuple
+
+def get_resampler(cache: Dict[Tuple[int, int], torchaudio.transforms.Resample],
+                  orig_sample_rate: int,
+                  target_sample_rate: int,
+                  device: Optional[torch.device] = None) -> torchaudio.transforms.Resample:
+    """
+    Get a resampler between two rates, building it once per cache.
+    
+    Args:
+        cache: Per-owner dict of resamplers keyed on (orig, target) rate
+        orig_sample_rate: Sample rate of the input audio
+        target_sample_rate: Sample rate to resample to
+        device: Device to move the resampling kernel to, CPU if None
+        
+    Returns:
+        The cached Resample transform
+    """
+    key = (orig_sample_rate, target_sample_rate)
+    resampler = cache.get(key)
+    if resampler is None:
+        resampler = torchaudio.transforms.Resample(
+            orig_sample_rate,
+            target_sample_rate,
+            lowpass_filter_width=16,
+            resampling_method='sinc_interp_kaiser'
+        )
+        if device is not None:
+            resampler = resampler.to(device)
+        cache[key] = resampler
+    return resampler
+
+def segment_waveform(waveform: torch.Tensor,
+                     segment_length: int,
+                     step: int) -> torch.Tensor:
+    """
+    Split a mono waveform into overlapping fixed-length segments.
+    
+    Short audio is zero-padded to one full segment, and a last segment
+    aligned to the end is added when the windows stop short of it.
+    
+    Args:
+        waveform: Audio of shape (1, num_samples)
+        segment_length: Segment length in samples
+        step: Hop between segment starts in samples
+        
+    Returns:
+        Segments of shape (num_segments, segment_length)
+    """
+    num_samples = waveform.shape[1]
+    
+    # Pad short audio up to a single full segment
+    if num_samples < segment_length:
+        waveform = F.pad(waveform, (0, segment_length - num_samples))
+        num_samples = segment_length
+    
+    # Strided view over the waveform, one row per segment
+    segments = waveform.unfold(1, segment_length, step).squeeze(0)
+    
+    # Add a last segment if the windows stop short of the end
+    if (num_samples - segment_length) % step != 0:
+        segments = torch.cat([segments, waveform[:, -segment_length:]], dim=0)
+    
+    return segments.contiguous()
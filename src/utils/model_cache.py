@@ -0,0 +1,60 @@
+import functools
+import torch
+import torch.nn as nn
+from speechbrain.pretrained import EncoderClassifier
+
+def get_x_vector_model(source: str,
+                       savedir: str,
+                       precision: str = 'float32',
+                       device: str = 'cpu') -> EncoderClassifier:
+    """
+    Load an x-vector model once per process and share it between callers.
+    
+    The returned model is shared, so treat it as read-only: do not move it,
+    change its mode or register it as a submodule.
+    
+    Args:
+        source: HuggingFace hub id or local path of the pretrained model
+        savedir: Directory the pretrained files are cached in
+        precision: 'float32', 'int8' (dynamic quantization, CPU only) or
+            'float16' (half-precision embedding network, for CUDA with autocast)
+        device: Device the model is loaded on
+        
+    Returns:
+        The shared EncoderClassifier instance for this precision
+    """
+    # Positional call with a normalised device so every caller hits the same lru_cache key
+    return _load_x_vector_model(source, savedir, precision, str(torch.device(device)))
+
+@functools.lru_cache(maxsize=4)
+def _load_x_vector_model(source: str, savedir: str, precision: str, device: str) -> EncoderClassifier:
+    """Cached loader behind get_x_vector_model."""
+    # Loading through run_opts keeps speechbrain's own device in sync with the weights
+    model = EncoderClassifier.from_hparams(source=source, savedir=savedir, run_opts={'device': device})
+    
+    apply_x_vector_precision(model.mods, precision)
+    
+    return model
+
+def apply_x_vector_precision(mods: nn.ModuleDict, precision: str) -> nn.ModuleDict:
+    """
+    Convert an x-vector model's modules, in place, to the given precision.
+    
+    Args:
+        mods: The EncoderClassifier's mods, with an embedding_model entry
+        precision: 'float32', 'int8' or 'float16', see get_x_vector_model
+        
+    Returns:
+        The converted mods
+    """
+    if precision == 'int8':
+        # Dynamic quantization covers the Linear layers only; the TDNN Conv1d
+        # layers have no dynamic kernel and stay float32
+        torch.quantization.quantize_dynamic(mods, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif precision == 'float16':
+        # Only the embedding network; callers keep feature extraction in float32
+        mods.embedding_model.half()
+    elif precision != 'float32':
+        raise ValueError(f"Unsupported x-vector precision: {precision}")
+    
+    return mods
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# Add project root to Python path to enable imports
+project_root = Path(__file__).parent.parent
+sys.path.append(str(project_root))
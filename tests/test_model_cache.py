@@ -0,0 +1,50 @@
+import copy
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("speechbrain")
+
+import torch.nn as nn
+import torch.nn.functional as F
+from speechbrain.lobes.models.Xvector import Xvector
+
+from src.utils.model_cache import apply_x_vector_precision
+
+
+def _make_mods() -> nn.ModuleDict:
+    """Randomly initialised x-vector network, no download needed."""
+    torch.manual_seed(0)
+    return nn.ModuleDict({'embedding_model': Xvector(in_channels=24)}).eval()
+
+
+def _embed(mods: nn.ModuleDict, feats: torch.Tensor) -> torch.Tensor:
+    with torch.inference_mode():
+        return mods.embedding_model(feats).float().squeeze(1)
+
+
+def test_int8_embeddings_match_float():
+    mods = _make_mods()
+    feats = torch.randn(8, 300, 24)
+    
+    reference = _embed(mods, feats)
+    quantized = _embed(apply_x_vector_precision(copy.deepcopy(mods), 'int8'), feats)
+    
+    assert F.cosine_similarity(reference, quantized, dim=-1).min() > 0.99
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+def test_float16_embeddings_match_float():
+    mods = _make_mods().cuda()
+    feats = torch.randn(8, 300, 24, device='cuda')
+    
+    reference = _embed(mods, feats)
+    half = apply_x_vector_precision(copy.deepcopy(mods), 'float16')
+    with torch.autocast(device_type='cuda', dtype=torch.float16):
+        converted = _embed(half, feats)
+    
+    assert F.cosine_similarity(reference, converted, dim=-1).min() > 0.99
+
+
+def test_unknown_precision_raises():
+    with pytest.raises(ValueError):
+        apply_x_vector_precision(_make_mods(), 'int4')